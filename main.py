@@ -1,7 +1,9 @@
 import os
+import csv
 import datetime
 import logging
 import warnings
+from decimal import Decimal
 import pandas as pd
 import pyodbc
 from typing import Dict, Set, List
@@ -41,13 +43,27 @@ def connect_to_db(db_path: str) -> pyodbc.Connection:
     )
     return pyodbc.connect(conn_str)
 
-def load_transitive_closure_efficient(conn_transitive: pyodbc.Connection) -> Dict[str, Set[str]]:
+def parse_snomed_id(value: object) -> int:
+    """
+    Convert an ID value read from the database to an integer, refusing values that are
+    not whole integers. SNOMED CT identifiers can exceed 2**53, so a float may already
+    have been rounded and is rejected outright.
+    """
+    if isinstance(value, float):
+        raise ValueError(f"SNOMED ID {value!r} was read as a float and may have lost precision.")
+    if isinstance(value, Decimal) and value != value.to_integral_value():
+        raise ValueError(f"SNOMED ID {value!r} is not a whole number.")
+    # int() on text rejects forms such as "1.0" and "1E+17"
+    return int(value)
+
+def load_transitive_closure_efficient(conn_transitive: pyodbc.Connection) -> Dict[int, Set[int]]:
     """
     Efficiently load the entire transitive closure table into a dictionary.
-    Each key is a SuperTypeID and the value is the set of SubtypeIDs.
+    Each key is a SuperTypeID and the value is the set of SubtypeIDs, both held as
+    integers since SNOMED CT identifiers are numeric.
     """
     logging.info("Loading transitive closure table into memory...")
-    trans_dict: Dict[str, Set[str]] = {}
+    trans_dict: Dict[int, Set[int]] = {}
     cursor = conn_transitive.cursor()
     cursor.execute("SELECT SuperTypeID, SubtypeID FROM SCTTC")
     batch_size = 10000
@@ -56,21 +72,24 @@ def load_transitive_closure_efficient(conn_transitive: pyodbc.Connection) -> Dic
         if not rows:
             break
         for row in rows:
-            super_code = str(row.SuperTypeID).strip()
-            sub_code = str(row.SubtypeID).strip()
+            # Skip incomplete rows rather than failing the whole load
+            if row.SuperTypeID is None or row.SubtypeID is None:
+                continue
+            super_code = parse_snomed_id(row.SuperTypeID)
+            sub_code = parse_snomed_id(row.SubtypeID)
             if super_code not in trans_dict:
                 trans_dict[super_code] = set()
             trans_dict[super_code].add(sub_code)
     logging.info(f"Loaded transitive closure table with {len(trans_dict)} keys.")
     return trans_dict
 
-def load_history_table_efficient(conn_history: pyodbc.Connection) -> Dict[str, Set[str]]:
+def load_history_table_efficient(conn_history: pyodbc.Connection) -> Dict[int, Set[int]]:
     """
     Efficiently load the entire history table into a dictionary.
-    Each key is an OLDCUI and the value is the set of NEWCUI values.
+    Each key is an OLDCUI and the value is the set of NEWCUI values, held as integers.
     """
     logging.info("Loading history table into memory...")
-    history_dict: Dict[str, Set[str]] = {}
+    history_dict: Dict[int, Set[int]] = {}
     cursor = conn_history.cursor()
     cursor.execute("SELECT OLDCUI, NEWCUI FROM SCTHIST")
     batch_size = 10000
@@ -79,45 +98,55 @@ def load_history_table_efficient(conn_history: pyodbc.Connection) -> Dict[str, S
         if not rows:
             break
         for row in rows:
-            old_code = str(row.OLDCUI).strip()
-            new_code = str(row.NEWCUI).strip()
+            # Skip incomplete history rows rather than failing the whole load
+            if row.OLDCUI is None or row.NEWCUI is None:
+                continue
+            old_code = parse_snomed_id(row.OLDCUI)
+            new_code = parse_snomed_id(row.NEWCUI)
             if old_code not in history_dict:
                 history_dict[old_code] = set()
             history_dict[old_code].add(new_code)
     logging.info(f"Loaded history table with {len(history_dict)} keys.")
     return history_dict
 
-def expand_codes_for_concept(code: str,
-                             history_dict: Dict[str, Set[str]],
-                             trans_dict: Dict[str, Set[str]]) -> Set[str]:
+def expand_codes_for_concept(code: int,
+                             history_dict: Dict[int, Set[int]],
+                             trans_dict: Dict[int, Set[int]]) -> Set[int]:
     """
     Expand a given SNOMED code by including any history replacements and recursively
     finding all child codes (and their history replacements). Both the original and any
     replacement codes are used as expansion points.
+
+    SCTTC is already a transitive closure, so a child reached through it needs no lookup
+    of its own: its subtypes were all returned with its ancestor. Only the original code
+    and history replacements are looked up, and each child is visited once.
     """
     # Start with the original code and its history replacements (if any)
-    base_set: Set[str] = {code} | history_dict.get(code, set())
-    expanded_codes: Set[str] = set(base_set)
-    to_process: Set[str] = set(base_set)
-
-    while to_process:
-        new_codes: Set[str] = set()
-        for current_code in to_process:
-            children = trans_dict.get(current_code, set())
-            for child in children:
-                child_replacements = history_dict.get(child, set())
-                new_codes.add(child)
-                new_codes |= child_replacements
-        new_codes -= expanded_codes
-        if not new_codes:
-            break
-        expanded_codes |= new_codes
-        to_process = new_codes
+    expanded_codes: Set[int] = {code} | history_dict.get(code, set())
+    # Codes already reached through the transitive closure table
+    descendants: Set[int] = set()
+    frontier: List[int] = list(expanded_codes)
+
+    while frontier:
+        next_frontier: List[int] = []
+        for current_code in frontier:
+            if current_code in descendants:
+                continue
+            for child in trans_dict.get(current_code, ()):
+                if child in descendants:
+                    continue
+                descendants.add(child)
+                expanded_codes.add(child)
+                for replacement in history_dict.get(child, ()):
+                    if replacement not in expanded_codes:
+                        expanded_codes.add(replacement)
+                        next_frontier.append(replacement)
+        frontier = next_frontier
     return expanded_codes
 
 def process_csv_to_table(input_csv: str, output_csv: str,
-                         history_dict: Dict[str, Set[str]],
-                         trans_dict: Dict[str, Set[str]]) -> tuple[int, int, int]:
+                         history_dict: Dict[int, Set[int]],
+                         trans_dict: Dict[int, Set[int]]) -> tuple[int, int, int]:
     """
     Read the input CSV, filter for rows where Code System is 'SNOMED CT',
     expand the SNOMED codes for each cluster (using the 'Aliases' field as cluster ID),
@@ -128,42 +157,56 @@ def process_csv_to_table(input_csv: str, output_csv: str,
         tuple containing (initial_count, added_count, final_count)
     """
     logging.info(f"Reading input CSV file '{input_csv}'.")
-    df = pd.read_csv(input_csv, dtype=str)
+    df = pd.read_csv(input_csv, dtype=str, usecols=["Code System", "Aliases", "Code"])
     # Filter for rows where Code System is SNOMED CT
     snomed_mask = df["Code System"].str.upper() == "SNOMED CT"
     df_snomed = df[snomed_mask]
+    # Rows without an alias cannot be assigned to a cluster
+    df_with_alias = df_snomed.dropna(subset=["Aliases"])
+    if len(df_with_alias) < len(df_snomed):
+        logging.warning(f"Skipping {len(df_snomed) - len(df_with_alias)} SNOMED rows with no cluster alias.")
+    df_snomed = df_with_alias
 
     # Count total initial unique SNOMED codes
     total_initial_codes = len(df_snomed["Code"].dropna().unique())
     logging.info(f"Initial unique SNOMED codes: {total_initial_codes}")
 
-    unique_clusters = df_snomed["Aliases"].unique()
-    logging.info(f"Found {len(unique_clusters)} unique cluster IDs to process.")
+    # Base code for each cluster is the first row for that alias
+    base_codes: Dict[str, str] = df_snomed.drop_duplicates("Aliases").set_index("Aliases")["Code"].to_dict()
+    logging.info(f"Found {len(base_codes)} unique cluster IDs to process.")
 
-    output_rows: List[Dict[str, str]] = []
     total_final_codes = 0
-    
-    for cluster_id in unique_clusters:
-        cluster_rows = df_snomed[df_snomed["Aliases"] == cluster_id]
-        base_code = cluster_rows.iloc[0]["Code"]
-        if not base_code or pd.isna(base_code):
-            logging.warning(f"Cluster '{cluster_id}' has no base code; skipping.")
-            continue
-
-        base_code = base_code.strip()
-        try:
-            expanded = expand_codes_for_concept(base_code, history_dict, trans_dict)
+    # Clusters often share a base code, so expand each distinct code only once and keep
+    # the result only until the last cluster using that code has been written
+    uses_left: Dict[str, int] = pd.Series(base_codes).dropna().str.strip().value_counts().to_dict()
+    shared_expansions: Dict[str, Set[int]] = {}
+
+    # Stream rows to the output file per cluster rather than holding the whole table in memory
+    with open(output_csv, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Cluster ID", "Code"])
+        for cluster_id, base_code in base_codes.items():
+            if not base_code or pd.isna(base_code):
+                logging.warning(f"Cluster '{cluster_id}' has no base code; skipping.")
+                continue
+
+            base_code = base_code.strip()
+            uses_left[base_code] -= 1
+            try:
+                expanded = shared_expansions.pop(base_code, None)
+                if expanded is None:
+                    expanded = expand_codes_for_concept(int(base_code), history_dict, trans_dict)
+            except Exception as e:
+                logging.error(f"Error expanding cluster '{cluster_id}': {e}")
+                continue
+            if uses_left[base_code] > 0:
+                shared_expansions[base_code] = expanded
             final_count = len(expanded)
             total_final_codes += final_count
             logging.info(f"Cluster '{cluster_id}': expanded to {final_count} codes.")
-            for code in sorted(expanded):
-                output_rows.append({"Cluster ID": cluster_id, "Code": code})
-        except Exception as e:
-            logging.error(f"Error expanding cluster '{cluster_id}': {e}")
-
-    df_output = pd.DataFrame(output_rows)
-    df_output.to_csv(output_csv, index=False, encoding='utf-8-sig')
-    logging.info(f"Expanded table CSV file '{output_csv}' created with {len(df_output)} rows.")
+            writer.writerows((cluster_id, code) for code in sorted(expanded))
+
+    logging.info(f"Expanded table CSV file '{output_csv}' created with {total_final_codes} rows.")
     
     return total_initial_codes, total_final_codes - total_initial_codes, total_final_codes
 